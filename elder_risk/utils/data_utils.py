@@ -1,11 +1,69 @@
 # elder_risk/utils/data_utils.py
+import atexit
+import errno
+import itertools
+import os
+import queue
 import shutil
+import subprocess
+import tarfile
 import tempfile
-from collections.abc import Callable
-from pathlib import Path
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from collections.abc import Callable, Generator, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from fnmatch import fnmatch
+from functools import lru_cache
+from pathlib import Path, PurePosixPath
+from typing import IO
 
 import patoolib  # type: ignore[import-untyped]
 from loguru import logger
+from patoolib.mime import guess_mime_mimedb  # type: ignore[import-untyped]
+
+# Suffixes of the archive formats patool can extract (.tar.gz etc. are caught by their last suffix)
+_ARCHIVE_SUFFIXES = frozenset(
+    {
+        ".rar",
+        ".zip",
+        ".7z",
+        ".tar",
+        ".gz",
+        ".bz2",
+        ".xz",
+        ".tgz",
+        ".tbz2",
+        ".zst",
+        ".lz4",
+        ".cab",
+        ".arj",
+        ".iso",
+    }
+)
+
+# Content-sniffed formats of suffix-less files, keyed by (size, first bytes)
+_MAGIC_PREFIX_LEN = 16
+_MAGIC_FORMATS: dict[tuple[int, bytes], str | None] = {}
+
+# RAM-backed scratch space for intermediate extraction, when the system has one
+_TMPFS = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+# Only use tmpfs when the archive would take at most this fraction of its free space
+_TMPFS_MAX_FILL = 0.5
+
+# Scratch trees of runs still in progress, removed at exit if a run is cut short
+_LIVE_SCRATCH: set[Path] = set()
+
+# ZIP compression methods the zipfile module can read
+_ZIP_METHODS = frozenset(
+    {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA}
+)
+
+# Reusable copy buffers for streaming archive members to disk
+_COPY_BUFFER_SIZE = 1 << 20
+_COPY_BUFFERS: queue.SimpleQueue[bytearray] = queue.SimpleQueue()
 
 
 def extract_nested_archives(
@@ -16,6 +74,10 @@ def extract_nested_archives(
     extract_callback: Callable[[Path], None] | None = None,
     should_extract: Callable[[Path], bool] | None = None,
     flatten: bool = True,
+    parallel: bool = True,
+    durable: bool = False,
+    refresh: bool = False,
+    should_extract_glob: str | None = None,
 ) -> list[Path]:
     """
     Extract nested archives recursively (supports RAR, ZIP, 7z, and many more).
@@ -26,8 +88,16 @@ def extract_nested_archives(
         password: Password for encrypted archives (Note: password support depends on backend)
         max_depth: Maximum nesting depth to prevent infinite loops
         extract_callback: Called after each file extraction with the extracted path
-        should_extract: Predicate to determine if a file should be extracted
+        should_extract: Predicate to determine if a file should be extracted (for ZIP/TAR
+            members it sees the path before the member is written)
         flatten: If True, extract all files to a flat structure, otherwise preserve nesting
+        parallel: If True, extract sibling nested archives concurrently in worker processes
+        durable: If True, flush extracted files to disk once at the end; otherwise leave
+            write-back to the OS
+        refresh: If True, drop memoized archive-format and tool lookups before starting
+        should_extract_glob: Non-empty glob on file names, e.g. "10*"; the filter when
+            should_extract is None, and passed to unrar/7z in nested mode so that
+            non-matching members are never written. It should agree with should_extract.
 
     Returns:
         List of paths to all extracted files
@@ -45,178 +115,986 @@ def extract_nested_archives(
 
     logger.info(f"Starting extraction of {archive_path.name} to {output_dir}")
 
-    # Define recursive helpers as closures to avoid passing unchanged parameters
-    def _extract_recursive_flat(archive: Path, current_depth: int) -> list[Path]:
-        """Extract archives recursively to a flat directory structure."""
+    if refresh:
+        _clear_caches()
+
+    if password:
+        logger.warning("Password provided but may not be supported by all backends")
+
+    if should_extract_glob == "":
+        raise ValueError("should_extract_glob must not be empty")
+
+    if should_extract is None and should_extract_glob is not None:
+        pattern = should_extract_glob
+
+        def should_extract(item: Path) -> bool:
+            return fnmatch(item.name, pattern)
+
+    if flatten:
+        extracted = _extract_flat(
+            archive_path, output_dir, max_depth, should_extract, extract_callback, parallel
+        )
+    else:
+        extracted = _extract_nested(
+            archive_path,
+            output_dir,
+            max_depth,
+            should_extract,
+            should_extract_glob,
+            extract_callback,
+            parallel,
+        )
+
+    # One flush for the whole run instead of one per file
+    if durable:
+        _sync_to_disk(extracted)
 
-        if current_depth >= max_depth:
-            logger.warning(f"Max recursion depth {max_depth} reached. Skipping {archive.name}")
-            return []
+    return extracted
 
-        logger.debug(f"Extracting {archive.name} at depth {current_depth}")
 
-        # Each archive is extracted to its own temporary directory for isolation
-        with tempfile.TemporaryDirectory(prefix=f"{archive.stem}_") as temp_dir_str:
-            temp_dir = Path(temp_dir_str)
-            extracted_files: list[Path] = []
+def _extract_flat(
+    archive: Path,
+    output_dir: Path,
+    max_depth: int,
+    should_extract: Callable[[Path], bool] | None,
+    extract_callback: Callable[[Path], None] | None,
+    parallel: bool,
+) -> list[Path]:
+    """Extract archives recursively to a flat directory structure."""
+
+    # All nested archives are expanded under a single scratch directory, then the
+    # leaves are moved out; moves stay in this process to avoid name races.
+    scratch_root = _scratch_root(archive)
+    scratch_dir = _make_scratch_dir(scratch_root)
+    # tmpfs can still fill up mid-run; archives that fail there are retried on disk
+    spill_dir = _make_scratch_dir(None) if scratch_root is not None else None
+    batches: Generator[list[Path], None, None] | None = None
+    try:
+        # Names are compared the way the filesystem will compare them
+        fold: Callable[[str], str] = str.casefold if _is_case_insensitive(output_dir) else str
+        with os.scandir(output_dir) as it:
+            taken = {fold(entry.name) for entry in it}
+        placed: set[Path] = set()
+
+        # Only the filtering variant tests the predicate per file
+        if should_extract is None:
+
+            def _reserve(item: Path) -> Path | None:
+                """Reserve a unique destination name for item."""
+                return _get_unique_path(output_dir, item, taken, fold)
 
+        else:
+            keep = should_extract
+
+            def _reserve(item: Path) -> Path | None:
+                """Apply the filter and reserve a unique destination name for item."""
+                if not keep(item):
+                    logger.debug("Skipping {} based on filter", item.name)
+                    return None
+                return _get_unique_path(output_dir, item, taken, fold)
+
+        def _place_leaf(item: Path) -> Path | None:
+            """Reserve a destination for a leaf a streaming backend writes directly."""
+            dest_path = _reserve(item)
+            if dest_path:
+                placed.add(dest_path)
+            return dest_path
+
+        def _release_leaf(dest_path: Path) -> None:
+            """Give back the name of a streamed leaf whose archive failed to extract."""
+            placed.discard(dest_path)
+            taken.discard(fold(dest_path.name))
+
+        # The producer thread extracts, filters and reserves names while this thread
+        # moves files and runs callbacks, so moves overlap the next decompression.
+        # Moves travel a whole archive's batch at a time, one queue handoff each.
+        moves: queue.Queue[list[tuple[Path, Path]] | None] = queue.Queue(maxsize=64)
+        stop = threading.Event()
+
+        # The first batch is taken in this thread: the process pool for nested archives
+        # is forked while it is expanded, and must fork before the producer thread exists
+        batches = _expand_archive(
+            archive, scratch_dir, spill_dir, max_depth, parallel, _place_leaf, _release_leaf
+        )
+        first_batch = next(batches, [])
+
+        def _produce() -> None:
             try:
-                # Use patoolib to extract - it handles everything with one call
-                if password and current_depth == 0:  # Only warn once
-                    logger.warning("Password provided but may not be supported by all backends")
-
-                patoolib.extract_archive(
-                    str(archive),
-                    outdir=str(temp_dir),
-                    verbosity=-1,  # Suppress patool output since we use loguru
-                )
-                logger.debug(f"Extracted {archive.name} to temporary directory")
+                for leaves in itertools.chain([first_batch], batches):
+                    if stop.is_set():
+                        break
+                    batch = []
+                    for item in leaves:
+                        # Streamed leaves are already in place
+                        dest_path = item if item in placed else _reserve(item)
+                        if dest_path:
+                            batch.append((item, dest_path))
+                    if batch:
+                        moves.put(batch)
+            finally:
+                moves.put(None)
 
-            except Exception as e:
-                logger.error(f"Failed to extract archive {archive.name}: {e}")
-                return []
+        extracted_files: list[Path] = []
+        record: Callable[[Path], None] = extracted_files.append
+        if extract_callback is not None:
+            callback = extract_callback
+
+            def record(dest_path: Path) -> None:
+                # A failing callback drops the file from the results, not the whole run
+                try:
+                    callback(dest_path)
+                except Exception as e:
+                    logger.error(f"Extract callback failed for {dest_path.name}: {e}")
+                    return
+                extracted_files.append(dest_path)
+
+        same_device: dict[Path, bool] = {}
+        output_dev = os.stat(output_dir).st_dev
+        move_file = _move_file_to_destination
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            producer = executor.submit(_produce)
+            batch = moves.get()
+            try:
+                while batch is not None:
+                    for source, dest_path in batch:
+                        if source == dest_path or move_file(
+                            source, dest_path, same_device, output_dev
+                        ):
+                            record(dest_path)
+                    batch = moves.get()
+            finally:
+                # On error, let the producer wind down instead of blocking on a full queue
+                stop.set()
+                while batch is not None:
+                    batch = moves.get()
+            producer.result()
+    finally:
+        # Shuts the process pool down if the producer stopped early
+        if batches is not None:
+            batches.close()
+        # The whole scratch tree goes in one rmtree
+        _remove_scratch_dir(scratch_dir)
+        if spill_dir is not None:
+            _remove_scratch_dir(spill_dir)
+
+    return extracted_files
+
+
+def _extract_nested(
+    archive: Path,
+    output_dir: Path,
+    max_depth: int,
+    should_extract: Callable[[Path], bool] | None,
+    include: str | None,
+    extract_callback: Callable[[Path], None] | None,
+    parallel: bool,
+) -> list[Path]:
+    """
+    Extract archives recursively preserving directory structure.
+
+    Each archive is extracted next to itself into a directory named after its stem.
+    Archives wait on a worklist; when parallel is set and more than one is pending,
+    they are extracted in worker processes while this process walks finished ones.
+    Members rejected by should_extract are not written: ZIP/TAR members are checked
+    as they are streamed, and include is handed to the unrar/7z backends as a mask.
+    """
+    extracted_files: list[Path] = []
+    process = _make_file_step(extracted_files, should_extract, extract_callback)
+    record = _make_file_step(extracted_files, None, extract_callback)
+    work: deque[tuple[Path, Path, int]] = deque([(archive, output_dir, 0)])
+    running: deque[tuple[Future[bool], Path, Path, int]] = deque()
+    executor: ProcessPoolExecutor | None = None
+
+    route: Callable[[Path], Path | None] | None = None
+    if should_extract is not None:
+        keep = should_extract
+
+        def _route(target: Path) -> Path | None:
+            return target if keep(target) else None
+
+        route = _route
+
+    try:
+        while work or running:
+            if work:
+                archive, target_dir, current_depth = work.popleft()
+                if current_depth >= max_depth:
+                    logger.warning(
+                        f"Max recursion depth {max_depth} reached. Skipping {archive.name}"
+                    )
+                    continue
 
-            # Process the contents of the temporary directory
-            for item in temp_dir.rglob("*"):  # rglob finds files in subdirectories
-                if not item.is_file():
+                logger.debug(f"Extracting {archive.name} at depth {current_depth}")
+                # Create a subdirectory for this archive's contents
+                extract_dir = target_dir / archive.stem
+                try:
+                    extract_dir.mkdir(parents=True, exist_ok=True)
+                except OSError as e:
+                    # e.g. a suffix-less archive whose stem is its own name
+                    logger.error(f"Failed to extract archive {archive.name}: {e}")
                     continue
 
-                # Check if it's an archive and we have depth remaining to recurse
-                if _is_archive(item) and current_depth + 1 < max_depth:
-                    logger.info(f"Found nested archive: {item.name}")
-                    nested_files = _extract_recursive_flat(item, current_depth + 1)
-                    extracted_files.extend(nested_files)
-                else:
-                    # Treat as a regular file (either not an archive or at max depth)
-                    if _is_archive(item) and current_depth + 1 >= max_depth:
-                        logger.debug(f"Max depth reached, treating {item.name} as regular file")
-
-                    # Move file to destination
-                    dest_path = _move_file_to_destination(
-                        item, output_dir, should_extract, extract_callback
+                # The predicate may not pickle, so filtered streaming stays in this process
+                prefiltered = route is not None and _backend_suffix(archive) in _STREAMERS
+
+                # Sibling archives extract into disjoint directories, so they can run concurrently
+                if parallel and (work or running) and not prefiltered:
+                    if executor is None:
+                        executor = ProcessPoolExecutor(max_workers=_worker_count(len(work) + 1))
+                    future = executor.submit(
+                        _extract_worker, (str(archive), str(extract_dir), include)
                     )
-                    if dest_path:
-                        extracted_files.append(dest_path)
+                    running.append((future, archive, target_dir, current_depth))
+                    continue
 
-        return extracted_files
+                try:
+                    ok = _extract_archive(archive, extract_dir, route, include)
+                except Exception as e:
+                    # The predicate failed mid-stream; as in the walk below, this ends the
+                    # archive but keeps the members it already let through
+                    logger.error(f"Failed to extract archive {archive.name}: {e}")
+                    ok = True
+            else:
+                future, archive, target_dir, current_depth = running.popleft()
+                extract_dir = target_dir / archive.stem
+                prefiltered = False
+                ok = future.result()
 
-    def _extract_recursive_nested(
-        archive: Path, target_dir: Path, current_depth: int
-    ) -> list[Path]:
-        """Extract archives recursively preserving directory structure."""
+            if not ok:
+                continue
 
-        if current_depth >= max_depth:
-            logger.warning(f"Max recursion depth {max_depth} reached. Skipping {archive.name}")
-            return []
+            # Streamed members were filtered before being written
+            step = record if prefiltered else process
+            try:
+                first_kept = len(extracted_files)
+                for entry in _iter_files(extract_dir):
+                    item = Path(entry.path)
+                    if not step(item):
+                        continue
 
-        logger.debug(f"Extracting {archive.name} at depth {current_depth}")
-        extracted_files: list[Path] = []
+                    # Per-file logs are formatted only if a sink wants DEBUG
+                    logger.opt(lazy=True).debug("Kept {}", lambda: item.relative_to(target_dir))
+
+                # If it's an archive, queue it for extraction; the files this archive
+                # kept are the tail of the shared output list, read in place by index
+                if current_depth < max_depth - 1:
+                    flags = _archive_flags(extracted_files, first_kept)
+                    for i, is_archive in enumerate(flags, first_kept):
+                        if is_archive:
+                            item = extracted_files[i]
+                            logger.info(f"Found nested archive: {item.name}")
+                            work.append((item, item.parent, current_depth + 1))
+
+            except Exception as e:
+                logger.error(f"Failed to extract archive {archive.name}: {e}")
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return extracted_files
+
+
+def _make_file_step(
+    extracted: list[Path],
+    should_extract: Callable[[Path], bool] | None,
+    extract_callback: Callable[[Path], None] | None,
+) -> Callable[[Path], bool]:
+    """
+    Build the per-file step: filter a file, record it and run the callback.
+
+    The step returns False for files the filter rejects. Each variant holds only the
+    branches the given hooks need, so the per-file loops don't re-test them.
+    """
+    append = extracted.append
+    if should_extract is not None and extract_callback is not None:
+        keep, callback = should_extract, extract_callback
+
+        def _step(item: Path) -> bool:
+            if not keep(item):
+                logger.debug("Skipping {} based on filter", item.name)
+                return False
+            append(item)
+            callback(item)
+            return True
+
+    elif should_extract is not None:
+        keep = should_extract
+
+        def _step(item: Path) -> bool:
+            if not keep(item):
+                logger.debug("Skipping {} based on filter", item.name)
+                return False
+            append(item)
+            return True
+
+    elif extract_callback is not None:
+        callback = extract_callback
+
+        def _step(item: Path) -> bool:
+            append(item)
+            callback(item)
+            return True
+
+    else:
+
+        def _step(item: Path) -> bool:
+            append(item)
+            return True
+
+    return _step
+
+
+def _extract_archive(
+    archive: Path,
+    outdir: Path,
+    route: Callable[[Path], Path | None] | None = None,
+    include: str | None = None,
+    failure_level: str = "ERROR",
+) -> bool:
+    """
+    Extract a single archive into outdir, returning False if extraction failed.
+
+    When route is given and the format can be streamed, each member is offered to
+    route with its would-be path under outdir and written wherever route says
+    (None skips it), so filtered members are never read. Otherwise include, a glob
+    on member file names, limits what the unrar/7z backends write.
+    A failure is logged at failure_level; exceptions raised by route propagate.
+    """
+    suffix = _backend_suffix(archive)
+    streamer = _STREAMERS.get(suffix) if route else None
+    try:
+        if streamer and route:
+            streamer(archive, outdir, _guard_route(route))
+        elif include is not None and suffix in _MASKING_BACKENDS:
+            _MASKING_BACKENDS[suffix](archive, outdir, include)
+        else:
+            _BACKENDS.get(suffix, _extract_with_patool)(archive, outdir)
+    except _RouteError as e:
+        # The caller's own hooks failed, not the archive, so the caller gets the error
+        raise e.error from None
+    except Exception as e:
+        logger.log(failure_level, f"Failed to extract archive {archive.name}: {e}")
+        return False
+
+    logger.debug(f"Extracted {archive.name} to {outdir}")
+    return True
 
+
+class _RouteError(Exception):
+    """Carries an exception raised by a route callback past the backend error handling."""
+
+    def __init__(self, error: Exception) -> None:
+        super().__init__(error)
+        self.error = error
+
+
+def _guard_route(route: Callable[[Path], Path | None]) -> Callable[[Path], Path | None]:
+    """Wrap route so that its exceptions can be told apart from the backend's."""
+
+    def _guarded(target: Path) -> Path | None:
         try:
-            # Create a subdirectory for this archive's contents
-            extract_dir = target_dir / archive.stem
-            extract_dir.mkdir(parents=True, exist_ok=True)
-
-            # Use patoolib to extract
-            if password and current_depth == 0:  # Only warn once
-                logger.warning("Password provided but may not be supported by all backends")
-
-            patoolib.extract_archive(
-                str(archive),
-                outdir=str(extract_dir),
-                verbosity=-1,  # Suppress patool output
-            )
-            logger.debug(f"Extracted {archive.name} to {extract_dir}")
-
-            # Process extracted files
-            for item in extract_dir.rglob("*"):
-                if not item.is_file():
+            return route(target)
+        except Exception as e:
+            raise _RouteError(e) from e
+
+    return _guarded
+
+
+def _backend_suffix(archive: Path) -> str:
+    """Return the _BACKENDS key for an archive, preferring compound suffixes like .tar.gz."""
+    compound = "".join(archive.suffixes[-2:]).lower()
+    return compound if compound in _BACKENDS else archive.suffix.lower()
+
+
+def _extract_with_patool(archive: Path, outdir: Path) -> None:
+    """Fallback backend: let patool sniff the format and pick a tool."""
+    patoolib.extract_archive(
+        str(archive),
+        outdir=str(outdir),
+        verbosity=-1,  # Suppress patool output since we use loguru
+    )
+
+
+def _extract_zip(archive: Path, outdir: Path) -> None:
+    """Extract a ZIP archive in-process, keeping member permissions and mtimes like unzip."""
+    with zipfile.ZipFile(archive) as zf:
+        infos = zf.infolist()
+        # Checked before anything is written, so the fallback starts from an empty outdir
+        readable = all(info.compress_type in _ZIP_METHODS for info in infos)
+        for info in infos if readable else ():
+            path = Path(zf.extract(info, outdir))
+            if not info.is_dir():
+                _set_zip_metadata(path, info)
+
+    if not readable:
+        # e.g. Deflate64 from Windows Explorer, or AES; unzip/7z can handle those
+        logger.debug(f"{archive.name} uses a compression method zipfile lacks, using patool")
+        _extract_with_patool(archive, outdir)
+
+
+def _extract_tar(archive: Path, outdir: Path) -> None:
+    """Extract a (possibly compressed) TAR archive in-process."""
+    with tarfile.open(archive) as tf:
+        tf.extractall(outdir, filter=_skip_unsafe_member)
+
+
+def _skip_unsafe_member(member: tarfile.TarInfo, dest_path: str) -> tarfile.TarInfo | None:
+    """The "data" extraction filter, except that rejected members are skipped, not fatal."""
+    try:
+        return tarfile.data_filter(member, dest_path)
+    except tarfile.FilterError as e:
+        logger.warning(f"Skipping {member.name}: {e}")
+        return None
+
+
+def _extract_rar(archive: Path, outdir: Path, include: str | None = None) -> None:
+    """Extract a RAR archive with unrar directly, skipping patool's dispatch."""
+    if _backend_available("unrar") is None:
+        _extract_with_patool(archive, outdir)
+        return
+
+    # -p- stops unrar prompting for a password on encrypted archives
+    args = ["unrar", "x", "-idq", "-y", "-p-"]
+    if include is not None:
+        args += ["-r", f"-n{include}"]
+    subprocess.run([*args, str(archive), f"{outdir}{os.sep}"], check=True, stdin=subprocess.DEVNULL)
+
+
+def _extract_7z(archive: Path, outdir: Path, include: str | None = None) -> None:
+    """Extract a 7z archive with the 7z CLI directly, skipping patool's dispatch."""
+    if _backend_available("7z") is None:
+        _extract_with_patool(archive, outdir)
+        return
+
+    args = ["7z", "x", "-y", "-bd", "-bso0", f"-o{outdir}"]
+    if include is not None:
+        args.append(f"-ir!{include}")
+    subprocess.run([*args, str(archive)], check=True, stdin=subprocess.DEVNULL)
+
+
+# Formats we can extract without patool re-sniffing the file; anything else falls back to it
+_BACKENDS: dict[str, Callable[[Path, Path], None]] = {
+    ".zip": _extract_zip,
+    ".tar": _extract_tar,
+    ".tgz": _extract_tar,
+    ".tbz2": _extract_tar,
+    ".tar.gz": _extract_tar,
+    ".tar.bz2": _extract_tar,
+    ".tar.xz": _extract_tar,
+    ".rar": _extract_rar,
+    ".7z": _extract_7z,
+}
+
+# Backends that can limit extraction to member names matching a glob
+_MASKING_BACKENDS: dict[str, Callable[[Path, Path, str], None]] = {
+    ".rar": _extract_rar,
+    ".7z": _extract_7z,
+}
+
+
+def _member_path(root: Path, name: str) -> Path | None:
+    """Map an archive member name under root, dropping absolute and parent-directory parts."""
+    parts = [
+        part for part in PurePosixPath(name.replace("\\", "/")).parts if part not in ("/", "..")
+    ]
+    return root.joinpath(*parts) if parts else None
+
+
+def _copy_stream(src: IO[bytes], dest_path: Path) -> None:
+    """Copy src into a new file at dest_path through a pooled buffer, removing it on failure."""
+    try:
+        buffer = _COPY_BUFFERS.get_nowait()
+    except queue.Empty:
+        buffer = bytearray(_COPY_BUFFER_SIZE)
+
+    view = memoryview(buffer)
+    try:
+        with open(dest_path, "wb") as dst:
+            while n := src.readinto(view):  # type: ignore[attr-defined]
+                dst.write(view[:n])
+    except BaseException:
+        dest_path.unlink(missing_ok=True)
+        raise
+    finally:
+        view.release()
+        _COPY_BUFFERS.put(buffer)
+
+
+def _set_zip_metadata(path: Path, info: zipfile.ZipInfo) -> None:
+    """Give an extracted ZIP member its stored permissions (if made on Unix) and mtime."""
+    mode = info.external_attr >> 16
+    if info.create_system == 3 and mode:
+        os.chmod(path, mode & 0o777)
+    # ZIP timestamps are local time without a zone, which is how unzip reads them
+    mtime = time.mktime((*info.date_time, 0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+
+def _stream_zip(archive: Path, root: Path, route: Callable[[Path], Path | None]) -> None:
+    """Write ZIP members one by one to the paths route picks for them."""
+    made_dirs: set[Path] = set()
+    with zipfile.ZipFile(archive) as zf:
+        infos = zf.infolist()
+        readable = all(info.compress_type in _ZIP_METHODS for info in infos)
+        for info in infos if readable else ():
+            target = None if info.is_dir() else _member_path(root, info.filename)
+            dest_path = route(target) if target else None
+            if dest_path is None:
+                continue
+
+            if dest_path.parent not in made_dirs:
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                made_dirs.add(dest_path.parent)
+            with zf.open(info) as src:
+                _copy_stream(src, dest_path)
+            _set_zip_metadata(dest_path, info)
+
+    if not readable:
+        logger.debug(f"{archive.name} uses a compression method zipfile lacks, using patool")
+        _route_with_patool(archive, root, route)
+
+
+def _route_with_patool(archive: Path, root: Path, route: Callable[[Path], Path | None]) -> None:
+    """Extract with patool to a staging directory, then move each file where route says."""
+    staging = Path(tempfile.mkdtemp(prefix=".staging_", dir=root))
+    try:
+        _extract_with_patool(archive, staging)
+        for item in [Path(entry.path) for entry in _iter_files(staging)]:
+            dest_path = route(root / item.relative_to(staging))
+            if dest_path is not None:
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(item, dest_path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def _stream_tar(archive: Path, root: Path, route: Callable[[Path], Path | None]) -> None:
+    """
+    Write regular TAR members one by one to the paths route picks for them.
+
+    Hard links are written as copies of their target, since extractfile follows them.
+    """
+    made_dirs: set[Path] = set()
+    with tarfile.open(archive) as tf:
+        for member in tf:
+            wanted = member.isfile() or member.islnk()
+            target = _member_path(root, member.name) if wanted else None
+            dest_path = route(target) if target else None
+            src = tf.extractfile(member) if dest_path else None
+            if dest_path is None or src is None:
+                continue
+
+            if dest_path.parent not in made_dirs:
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                made_dirs.add(dest_path.parent)
+            with src:
+                _copy_stream(src, dest_path)
+            os.chmod(dest_path, member.mode & 0o777)
+            os.utime(dest_path, (member.mtime, member.mtime))
+
+
+# Formats whose members can be written straight to their final location
+_STREAMERS: dict[str, Callable[[Path, Path, Callable[[Path], Path | None]], None]] = {
+    ".zip": _stream_zip,
+    ".tar": _stream_tar,
+    ".tgz": _stream_tar,
+    ".tbz2": _stream_tar,
+    ".tar.gz": _stream_tar,
+    ".tar.bz2": _stream_tar,
+    ".tar.xz": _stream_tar,
+}
+
+
+def _expand_archive(
+    archive: Path,
+    scratch_dir: Path,
+    spill_dir: Path | None,
+    max_depth: int,
+    parallel: bool,
+    place_leaf: Callable[[Path], Path | None] | None = None,
+    release_leaf: Callable[[Path], None] | None = None,
+) -> Generator[list[Path], None, None]:
+    """
+    Extract an archive and every archive nested inside it under scratch_dir.
+
+    Nothing is moved; each archive's leaf files are yielded as one list as soon as
+    it is extracted and the caller decides what to do with them. Archives wait on a
+    worklist; when parallel is set, the first level holding more than one nested
+    archive goes to worker processes, as do later ones whenever more than one is
+    pending. A chain of lone nested archives above it is expanded in this process,
+    and its leaves are yielded with the top-level archive's. Archives extracted in
+    this process pass place_leaf and release_leaf to _expand_one.
+
+    The process pool is only ever created, and its workers started, during the first
+    next(). A caller that resumes the generator from another thread should make that
+    call itself first, so the workers are not forked from a multi-threaded process.
+    """
+    work: deque[tuple[Path, int]] = deque([(archive, 0)])
+    running: deque[tuple[Future[tuple[list[str], list[str]]], int]] = deque()
+    executor: ProcessPoolExecutor | None = None
+    # Leaves gathered for the first batch, until it is yielded
+    first: list[Path] | None = []
+
+    def _submit(pool: ProcessPoolExecutor, archive: Path, current_depth: int) -> None:
+        # Only path strings cross the process boundary
+        spill = str(spill_dir) if spill_dir is not None else None
+        job = (str(archive), str(scratch_dir), spill, current_depth, max_depth)
+        running.append((pool.submit(_expand_worker, job), current_depth))
+
+    try:
+        while work or running:
+            if work:
+                archive, current_depth = work.popleft()
+                if executor is not None and (work or running):
+                    _submit(executor, archive, current_depth)
                     continue
 
-                # Apply filter first (don't delete files, just skip them)
-                if should_extract and not should_extract(item):
-                    logger.debug(f"Skipping {item.name} based on filter")
+                leaves, nested = _expand_one(
+                    archive,
+                    scratch_dir,
+                    spill_dir,
+                    current_depth,
+                    max_depth,
+                    place_leaf,
+                    release_leaf,
+                )
+            else:
+                # Collect worker results in submission order so the output is deterministic
+                future, current_depth = running.popleft()
+                leaf_paths, nested_paths = future.result()
+                leaves = [Path(leaf) for leaf in leaf_paths]
+                nested = [Path(item) for item in nested_paths]
+
+            work.extend((item, current_depth + 1) for item in nested)
+            if first is not None:
+                first.extend(leaves)
+                # A lone nested archive gains nothing from a pool, so it stays in-process
+                if parallel and len(work) == 1:
                     continue
+                if parallel and work:
+                    # Submitting straight away starts the workers before this generator
+                    # is handed to another thread
+                    executor = ProcessPoolExecutor(max_workers=_worker_count(len(work)))
+                    while work:
+                        _submit(executor, *work.popleft())
+                leaves, first = first, None
 
-                # If the file passed the filter, process it
-                extracted_files.append(item)
-                logger.debug(f"Kept {item.relative_to(target_dir)}")
+            yield leaves
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
-                if extract_callback:
-                    extract_callback(item)
 
-                # If it's an archive, recursively extract it
-                if _is_archive(item) and current_depth < max_depth - 1:
-                    logger.info(f"Found nested archive: {item.name}")
-                    nested_files = _extract_recursive_nested(item, item.parent, current_depth + 1)
-                    extracted_files.extend(nested_files)
+def _expand_one(
+    archive: Path,
+    scratch_dir: Path,
+    spill_dir: Path | None,
+    current_depth: int,
+    max_depth: int,
+    place_leaf: Callable[[Path], Path | None] | None = None,
+    release_leaf: Callable[[Path], None] | None = None,
+) -> tuple[list[Path], list[Path]]:
+    """
+    Extract a single archive into its own directory under scratch_dir.
 
-        except Exception as e:
-            logger.error(f"Failed to extract archive {archive.name}: {e}")
+    If place_leaf is given, leaves of streamable formats are written straight to the
+    destination it reserves (None drops them) and that destination is returned instead.
+    If extraction fails, those leaves are removed and handed to release_leaf, and the
+    archive is tried once more under spill_dir if one is given. A nested archive that
+    still fails (e.g. a plain file with an archive suffix) is returned as a leaf.
 
-        return extracted_files
+    Returns:
+        The leaf files, and the nested archives that still have depth left to recurse
+    """
+    if current_depth >= max_depth:
+        logger.warning(f"Max recursion depth {max_depth} reached. Skipping {archive.name}")
+        return [], []
 
-    # Dispatch to the appropriate internal helper
-    if flatten:
-        return _extract_recursive_flat(archive_path, 0)
+    logger.debug(f"Extracting {archive.name} at depth {current_depth}")
+
+    leaves: list[Path] = []
+    route: Callable[[Path], Path | None] | None = None
+    if place_leaf is not None:
+        leaf_sink = place_leaf
+
+        def _route(target: Path) -> Path | None:
+            # Possible nested archives stay in scratch so they can be probed and recursed into
+            suffix = target.suffix.lower()
+            if current_depth + 1 < max_depth and (not suffix or suffix in _ARCHIVE_SUFFIXES):
+                return target
+            dest_path = leaf_sink(target)
+            if dest_path:
+                leaves.append(dest_path)
+            return dest_path
+
+        route = _route
+
+    for root in (scratch_dir, spill_dir):
+        if root is None:
+            continue
+        if root is spill_dir:
+            logger.info(f"Retrying {archive.name} under {spill_dir}")
+
+        # Each archive is extracted to its own directory for isolation
+        extract_dir = root / f"lvl{current_depth}_{uuid.uuid4().hex[:8]}"
+        extract_dir.mkdir()
+        # Only the last attempt reports its failure as an error
+        level = "DEBUG" if root is scratch_dir and spill_dir is not None else "ERROR"
+        if _extract_archive(archive, extract_dir, route, failure_level=level):
+            break
+
+        # Don't leave a partial set of this archive's leaves behind
+        for dest_path in leaves:
+            dest_path.unlink(missing_ok=True)
+            if release_leaf is not None:
+                release_leaf(dest_path)
+        leaves.clear()
+        # Frees the space if tmpfs filled up
+        shutil.rmtree(extract_dir, ignore_errors=True)
+    else:
+        if current_depth == 0:
+            return [], []
+        # Nested archives are scratch copies, so the file itself can still be kept
+        logger.info(f"Keeping {archive.name} as a regular file")
+        return [archive], []
+
+    nested: list[Path] = []
+    items = [Path(entry.path) for entry in _iter_files(extract_dir)]
+    # Archives at max depth are treated as regular files
+    if current_depth + 1 < max_depth:
+        for item, is_archive in zip(items, _archive_flags(items)):
+            if is_archive:
+                logger.info(f"Found nested archive: {item.name}")
+                nested.append(item)
+            else:
+                leaves.append(item)
     else:
-        return _extract_recursive_nested(archive_path, output_dir, 0)
+        leaves.extend(items)
+
+    return leaves, nested
+
+
+def _expand_worker(job: tuple[str, str, str | None, int, int]) -> tuple[list[str], list[str]]:
+    """Process-pool entry point for _expand_one."""
+    archive, scratch_dir, spill, current_depth, max_depth = job
+    spill_dir = Path(spill) if spill is not None else None
+    leaves, nested = _expand_one(
+        Path(archive), Path(scratch_dir), spill_dir, current_depth, max_depth
+    )
+    return [str(leaf) for leaf in leaves], [str(item) for item in nested]
+
+
+def _extract_worker(job: tuple[str, str, str | None]) -> bool:
+    """Process-pool entry point for _extract_archive."""
+    archive, outdir, include = job
+    return _extract_archive(Path(archive), Path(outdir), include=include)
+
+
+def _make_scratch_dir(root: str | None) -> Path:
+    """Create a scratch tree for one flat-mode run under root; archives get subdirectories."""
+    scratch_dir = Path(tempfile.mkdtemp(prefix="archive_extract_scratch_", dir=root))
+    _LIVE_SCRATCH.add(scratch_dir)
+    return scratch_dir
+
+
+def _remove_scratch_dir(scratch_dir: Path) -> None:
+    """Remove a scratch tree created by _make_scratch_dir."""
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    _LIVE_SCRATCH.discard(scratch_dir)
+
+
+@atexit.register
+def _remove_leftover_scratch() -> None:
+    """Safety net for scratch trees whose run never reached its own cleanup."""
+    for scratch_dir in list(_LIVE_SCRATCH):
+        _remove_scratch_dir(scratch_dir)
+
+
+def _scratch_root(archive: Path) -> str | None:
+    """Pick tmpfs for scratch space if the archive comfortably fits, else the default temp dir."""
+    if _TMPFS is None:
+        return None
+
+    if archive.stat().st_size > shutil.disk_usage(_TMPFS).free * _TMPFS_MAX_FILL:
+        logger.debug(f"{archive.name} is too large for {_TMPFS}, using the default temp dir")
+        return None
+    return _TMPFS
+
+
+def _sync_to_disk(paths: list[Path]) -> None:
+    """Flush extracted files to stable storage, with a single sync where the OS has one."""
+    if hasattr(os, "sync"):
+        os.sync()
+        return
+
+    for path in paths:
+        with open(path, "rb+") as f:
+            os.fsync(f.fileno())
+
+
+def _worker_count(n_jobs: int) -> int:
+    """Size a process pool to the smaller of the job count and the available cores."""
+    return max(1, min(n_jobs, os.cpu_count() or 1))
+
+
+def _iter_files(root: Path) -> Iterator[os.DirEntry[str]]:
+    """
+    Yield every regular file under root.
+
+    DirEntry type checks use the d_type reported by the directory read, so unlike
+    Path.rglob + is_file there is no extra stat() per entry.
+    """
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
 
 
 def _is_archive(file_path: Path) -> bool:
     """Check if a file is an archive that can be extracted."""
+    suffix = file_path.suffix.lower()
+    if suffix:
+        # Decided by suffix alone so plain files never get opened
+        return suffix in _ARCHIVE_SUFFIXES and _format_for_suffix(suffix) is not None
+
+    # No suffix to go on, so look at the content
+    return _sniff_archive_format(file_path) is not None
+
+
+def _archive_flags(items: list[Path], start: int = 0) -> list[bool]:
+    """
+    Run _is_archive over items[start:], sniffing suffix-less files concurrently.
+
+    Files with a suffix are decided synchronously without IO; only the ones whose
+    content has to be read go to a thread pool, so their open/read waits overlap.
+    start lets a caller classify the tail of a list without copying it.
+    """
+    indices = range(start, len(items))
+    flags = [bool(items[i].suffix) and _is_archive(items[i]) for i in indices]
+    ambiguous = [i for i in indices if not items[i].suffix]
+    if len(ambiguous) == 1:
+        flags[ambiguous[0] - start] = _is_archive(items[ambiguous[0]])
+    elif ambiguous:
+        with ThreadPoolExecutor(max_workers=min(32, len(ambiguous))) as executor:
+            sniffed = executor.map(_is_archive, (items[i] for i in ambiguous))
+            for i, flag in zip(ambiguous, sniffed):
+                flags[i - start] = flag
+    return flags
+
+
+@lru_cache(maxsize=None)
+def _format_for_suffix(suffix: str) -> str | None:
+    """Map a suffix to patool's archive format using its extension database, without any IO."""
+    mime, _encoding = guess_mime_mimedb(f"archive{suffix}")
+    archive_format: str | None = patoolib.ArchiveMimetypes.get(mime)
+    return archive_format
+
+
+def _sniff_archive_format(file_path: Path) -> str | None:
+    """Detect an archive format from file content, memoized on (size, leading bytes)."""
+    # A raw descriptor: open() would fstat the file itself before we do
     try:
-        # patoolib can check if a file is a supported archive
-        patoolib.get_archive_format(str(file_path))
-        return True
-    except Exception:
-        return False
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        key = (os.fstat(fd).st_size, os.read(fd, _MAGIC_PREFIX_LEN))
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+    if key not in _MAGIC_FORMATS:
+        try:
+            # patoolib can check if a file is a supported archive
+            _MAGIC_FORMATS[key], _compression = patoolib.get_archive_format(str(file_path))
+        except Exception:
+            _MAGIC_FORMATS[key] = None
+    return _MAGIC_FORMATS[key]
 
 
-def _get_unique_path(directory: Path, original_path: Path) -> Path:
-    """Generate a unique path in a directory to avoid overwriting files."""
-    final_path = directory / original_path.name
-    if not final_path.exists():
-        return final_path
+# Tool lookups on PATH don't change during a run
+_backend_available = lru_cache(maxsize=None)(shutil.which)
 
-    stem = original_path.stem
-    suffix = original_path.suffix
-    counter = 1
-    while final_path.exists():
-        final_path = directory / f"{stem}_{counter}{suffix}"
-        counter += 1
-    logger.debug(f"Renamed {original_path.name} to {final_path.name} to avoid conflict")
-    return final_path
 
+def _clear_caches() -> None:
+    """Forget memoized format and tool lookups, e.g. after installing a new backend."""
+    _format_for_suffix.cache_clear()
+    _backend_available.cache_clear()
+    _MAGIC_FORMATS.clear()
 
-def _move_file_to_destination(
-    source: Path,
-    dest_dir: Path,
-    should_extract: Callable[[Path], bool] | None,
-    extract_callback: Callable[[Path], None] | None,
-) -> Path | None:
+
+def _get_unique_path(
+    directory: Path, original_path: Path, taken: set[str], fold: Callable[[str], str] = str
+) -> Path:
     """
-    Move a file to the destination directory, applying filters and callbacks.
+    Generate a unique path in a directory to avoid overwriting files.
 
-    Returns:
-        The destination path if successful, None if filtered out or failed
+    taken holds the names already present in (or reserved for) the directory, as
+    mapped by fold; the chosen name is added to it, so resolving a collision never
+    touches the disk. On case-insensitive filesystems fold should be str.casefold,
+    so that README.txt and readme.txt count as the same name.
     """
-    # Apply filter if provided
-    if should_extract and not should_extract(source):
-        logger.debug(f"Skipping {source.name} based on filter")
-        return None
+    name = original_path.name
+    candidate_name = name
+    if fold(candidate_name) in taken:
+        # Split once with plain string ops rather than re-deriving Path.stem/.suffix
+        dot = name.rfind(".")
+        if 0 < dot < len(name) - 1:
+            stem, suffix = name[:dot], name[dot:]
+        else:
+            stem, suffix = name, ""
 
-    # Get unique destination path
-    dest_path = _get_unique_path(dest_dir, source)
+        counter = 1
+        candidate_name = f"{stem}_{counter}{suffix}"
+        while fold(candidate_name) in taken:
+            counter += 1
+            candidate_name = f"{stem}_{counter}{suffix}"
+        logger.debug("Renamed {} to {} to avoid conflict", name, candidate_name)
+
+    taken.add(fold(candidate_name))
+    return Path(os.path.join(directory, candidate_name))
 
-    try:
-        shutil.move(str(source), str(dest_path))
-        logger.debug(f"Moved {source.name} to final destination")
 
-        if extract_callback:
-            extract_callback(dest_path)
+def _is_case_insensitive(directory: Path) -> bool:
+    """Probe whether the filesystem holding directory matches names case-insensitively."""
+    with tempfile.NamedTemporaryFile(prefix="CaseProbe_", dir=directory) as probe:
+        return os.path.exists(os.path.join(directory, os.path.basename(probe.name).swapcase()))
 
-        return dest_path
+
+def _move_file_to_destination(
+    source: Path, dest_path: Path, same_device: dict[Path, bool], dest_dev: int
+) -> bool:
+    """
+    Move a file to its reserved destination, returning False if the move failed.
+
+    same_device caches, per source directory, whether it shares a device with the
+    destination (whose st_dev the caller stats once as dest_dev), so cross-device
+    moves skip straight to copying instead of failing a rename first.
+    """
+    try:
+        parent = source.parent
+        if parent not in same_device:
+            same_device[parent] = os.stat(parent).st_dev == dest_dev
+
+        if same_device[parent]:
+            try:
+                # A plain rename is all a same-filesystem move needs
+                os.rename(source, dest_path)
+            except OSError as e:
+                # Bind mounts can share a device yet still refuse renames across them
+                if e.errno != errno.EXDEV:
+                    raise
+                same_device[parent] = False
+                shutil.move(str(source), str(dest_path))
+        else:
+            shutil.move(str(source), str(dest_path))
+        logger.debug("Moved {} to final destination", source.name)
+        return True
     except Exception as e:
         logger.error(f"Failed to move {source.name} to destination: {e}")
-        return None
+        return False
@@ -1,9 +1,14 @@
+import os
+import tarfile
 import tempfile
+import time
+import zipfile
 from pathlib import Path
 
 import pytest
 import rarfile
 
+from elder_risk.utils import data_utils
 from elder_risk.utils.data_utils import extract_nested_archives
 
 
@@ -26,6 +31,46 @@ def temp_dir():
         yield Path(tmpdir)
 
 
+@pytest.fixture
+def built_archive(tmp_path):
+    """Build outer.zip holding plain files, a nested tar.gz and a nested zip."""
+    inner = tmp_path / "src" / "inner"
+    inner.mkdir(parents=True)
+    (inner / "a.txt").write_text("inner a")
+    (inner / "readme.txt").write_text("inner readme")
+    with tarfile.open(tmp_path / "inner.tar.gz", "w:gz") as tf:
+        tf.add(inner, arcname="inner")
+    with zipfile.ZipFile(tmp_path / "more.zip", "w") as zf:
+        zf.writestr("c.txt", "c")
+    
+    archive = tmp_path / "outer.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("readme.txt", "outer readme")
+        zf.writestr("docs/b.txt", "b")
+        zf.write(tmp_path / "inner.tar.gz", "inner.tar.gz")
+        zf.write(tmp_path / "more.zip", "more.zip")
+    return archive
+
+
+@pytest.fixture
+def linked_tar(tmp_path):
+    """Build a tar.gz with an old executable script, a file and a hard link to it."""
+    src = tmp_path / "src" / "a"
+    src.mkdir(parents=True)
+    (src / "orig.txt").write_text("orig")
+    os.link(src / "orig.txt", src / "link.txt")
+    script = src / "run.sh"
+    script.write_text("#!/bin/sh\n")
+    script.chmod(0o755)
+    os.utime(script, (1_000_000_000, 1_000_000_000))
+    
+    archive = tmp_path / "linked.tar.gz"
+    with tarfile.open(archive, "w:gz") as tf:
+        for name in ("orig.txt", "link.txt", "run.sh"):
+            tf.add(src / name, arcname=f"a/{name}")
+    return archive
+
+
 class TestExtractNestedArchives:
     def test_extract_main_rar_file(self, test_rar_file, temp_dir):
         """Test extracting the main Tests.rar file."""
@@ -107,6 +152,24 @@ class TestExtractNestedArchives:
         for file_path in extracted:
             assert file_path.name.startswith('10')
     
+    def test_should_extract_glob_nested(self, test_rar_file, temp_dir):
+        """Test that files rejected by the glob are not written in nested mode."""
+        if not test_rar_file.exists():
+            pytest.skip(f"Test RAR file not found: {test_rar_file}")
+        
+        extracted = extract_nested_archives(
+            test_rar_file,
+            temp_dir,
+            max_depth=1,
+            should_extract_glob='10*',
+            flatten=False
+        )
+        
+        # Every file left on disk passed the filter
+        on_disk = [p for p in temp_dir.rglob('*') if p.is_file()]
+        assert all(p.name.startswith('10') for p in on_disk)
+        assert all(p.name.startswith('10') for p in extracted)
+    
     def test_output_directory_creation(self, test_rar_file):
         """Test that output directory is created if it doesn't exist."""
         if not test_rar_file.exists():
@@ -204,4 +267,355 @@ class TestExtractNestedArchives:
         
         assert len(extracted) > 0
         assert all(isinstance(p, Path) for p in extracted)
-        assert all(f.exists() for f in extracted)
\ No newline at end of file
+        assert all(f.exists() for f in extracted)
+    
+    def test_parallel_matches_serial(self, test_rar_file, temp_dir):
+        """Test that parallel extraction yields the same files as serial extraction."""
+        if not test_rar_file.exists():
+            pytest.skip(f"Test RAR file not found: {test_rar_file}")
+        
+        serial = extract_nested_archives(
+            test_rar_file, temp_dir / "serial", max_depth=2, parallel=False
+        )
+        parallel = extract_nested_archives(
+            test_rar_file, temp_dir / "parallel", max_depth=2, parallel=True
+        )
+        
+        assert sorted(p.name for p in serial) == sorted(p.name for p in parallel)
+    
+    def test_durable_extraction(self, test_rar_file, temp_dir):
+        """Test that durable extraction returns the same files, flushed to disk."""
+        if not test_rar_file.exists():
+            pytest.skip(f"Test RAR file not found: {test_rar_file}")
+        
+        extracted = extract_nested_archives(test_rar_file, temp_dir, max_depth=1, durable=True)
+        
+        assert len(extracted) > 0
+        assert all(f.exists() for f in extracted)
+
+
+class TestExtractBuiltArchives:
+    """Tests against small archives built on the fly, so they run without data/."""
+    
+    def test_nested_zip_and_tar(self, built_archive, tmp_path):
+        """Test that ZIP and TAR backends extract every level in nested mode."""
+        out = tmp_path / "out"
+        extracted = extract_nested_archives(built_archive, out, flatten=False, parallel=False)
+        
+        assert sorted(p.relative_to(out).as_posix() for p in extracted) == [
+            "outer/docs/b.txt",
+            "outer/inner.tar.gz",
+            "outer/inner.tar/inner/a.txt",
+            "outer/inner.tar/inner/readme.txt",
+            "outer/more.zip",
+            "outer/more/c.txt",
+            "outer/readme.txt",
+        ]
+        assert (out / "outer" / "inner.tar" / "inner" / "a.txt").read_text() == "inner a"
+    
+    def test_flat_renames_collisions(self, built_archive, tmp_path):
+        """Test that same-named leaves from different archives both land in flat mode."""
+        out = tmp_path / "out"
+        extracted = extract_nested_archives(built_archive, out, parallel=False)
+        
+        assert sorted(p.name for p in extracted) == [
+            "a.txt", "b.txt", "c.txt", "readme.txt", "readme_1.txt"
+        ]
+        readmes = {(out / name).read_text() for name in ("readme.txt", "readme_1.txt")}
+        assert readmes == {"outer readme", "inner readme"}
+    
+    def test_flat_keeps_existing_files(self, built_archive, tmp_path):
+        """Test that files already in the output directory are never overwritten."""
+        out = tmp_path / "out"
+        out.mkdir()
+        (out / "readme.txt").write_text("existing")
+        
+        extracted = extract_nested_archives(built_archive, out, parallel=False)
+        
+        assert (out / "readme.txt").read_text() == "existing"
+        assert sorted(p.name for p in extracted if p.name.startswith("readme")) == [
+            "readme_1.txt", "readme_2.txt"
+        ]
+    
+    def test_parallel_matches_serial(self, built_archive, tmp_path):
+        """Test that fanning nested archives out to worker processes changes nothing."""
+        for flatten in (True, False):
+            serial = extract_nested_archives(
+                built_archive, tmp_path / f"serial_{flatten}", flatten=flatten, parallel=False
+            )
+            parallel = extract_nested_archives(
+                built_archive, tmp_path / f"parallel_{flatten}", flatten=flatten, parallel=True
+            )
+            assert sorted(p.name for p in serial) == sorted(p.name for p in parallel)
+    
+    def test_pool_is_sized_to_the_nested_archives(self, built_archive, tmp_path, monkeypatch):
+        """Test that flat mode forks a worker per nested archive at most, and none for one."""
+        pool_sizes = []
+        process_pool = data_utils.ProcessPoolExecutor
+        
+        def spy(max_workers):
+            pool_sizes.append(max_workers)
+            return process_pool(max_workers=max_workers)
+        
+        monkeypatch.setattr(data_utils, "ProcessPoolExecutor", spy)
+        monkeypatch.setattr(os, "cpu_count", lambda: 8)
+        lone = tmp_path / "lone.zip"
+        with zipfile.ZipFile(lone, "w") as zf:
+            zf.write(built_archive, "outer.zip")
+        
+        extracted = extract_nested_archives(lone, tmp_path / "out", parallel=True)
+        
+        assert len(extracted) == 5
+        assert pool_sizes == [2]
+        
+        pool_sizes.clear()
+        single = tmp_path / "single.zip"
+        with zipfile.ZipFile(single, "w") as zf:
+            zf.write(tmp_path / "more.zip", "more.zip")
+        
+        assert len(extract_nested_archives(single, tmp_path / "single", parallel=True)) == 1
+        assert pool_sizes == []
+    
+    def test_streamed_member_names_are_sanitized(self, tmp_path):
+        """Test that absolute and parent-directory member names stay inside the output."""
+        archive = tmp_path / "evil.zip"
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("../up.txt", "up")
+            zf.writestr("/abs.txt", "abs")
+        out = tmp_path / "out"
+        
+        extracted = extract_nested_archives(archive, out)
+        
+        assert sorted(p.name for p in extracted) == ["abs.txt", "up.txt"]
+        assert all(p.parent == out for p in extracted)
+        assert not (tmp_path / "up.txt").exists()
+    
+    def test_should_extract_glob(self, built_archive, tmp_path):
+        """Test the glob filter: nested mode skips writing, flat mode still recurses."""
+        out = tmp_path / "nested"
+        nested = extract_nested_archives(
+            built_archive, out, flatten=False, should_extract_glob="*.txt"
+        )
+        on_disk = sorted(p.relative_to(out).as_posix() for p in out.rglob("*") if p.is_file())
+        
+        assert sorted(p.relative_to(out).as_posix() for p in nested) == on_disk
+        assert on_disk == ["outer/docs/b.txt", "outer/readme.txt"]
+        
+        flat = extract_nested_archives(
+            built_archive, tmp_path / "flat", should_extract_glob="readme*"
+        )
+        assert sorted(p.name for p in flat) == ["readme.txt", "readme_1.txt"]
+    
+    def test_positional_arguments_keep_their_meaning(self, built_archive, tmp_path):
+        """Test that callers passing flatten positionally still get nested output."""
+        out = tmp_path / "out"
+        extracted = extract_nested_archives(built_archive, out, None, 10, None, None, False)
+        
+        assert out / "outer" / "docs" / "b.txt" in extracted
+    
+    def test_empty_glob_is_rejected(self, built_archive, tmp_path):
+        """Test that an empty glob fails up front instead of filtering the modes differently."""
+        for flatten in (True, False):
+            with pytest.raises(ValueError):
+                extract_nested_archives(
+                    built_archive, tmp_path / "out", flatten=flatten, should_extract_glob=""
+                )
+    
+    def test_durable_extraction(self, built_archive, tmp_path):
+        """Test that durable extraction returns the same files as a normal run."""
+        plain = extract_nested_archives(built_archive, tmp_path / "plain", parallel=False)
+        durable = extract_nested_archives(
+            built_archive, tmp_path / "durable", parallel=False, durable=True
+        )
+        
+        assert sorted(p.name for p in durable) == sorted(p.name for p in plain)
+        assert all(f.exists() for f in durable)
+    
+    def test_flat_streaming_keeps_links_and_metadata(self, linked_tar, tmp_path):
+        """Test that streamed TAR leaves keep hard links, permissions and mtimes."""
+        out = tmp_path / "out"
+        extracted = extract_nested_archives(linked_tar, out)
+        
+        assert sorted(p.name for p in extracted) == ["link.txt", "orig.txt", "run.sh"]
+        assert (out / "link.txt").read_text() == "orig"
+        assert (out / "run.sh").stat().st_mode & 0o777 == 0o755
+        assert (out / "run.sh").stat().st_mtime == 1_000_000_000
+    
+    def test_filtered_nested_keeps_links_and_metadata(self, linked_tar, tmp_path):
+        """Test that filtered nested extraction keeps hard links, permissions and mtimes."""
+        out = tmp_path / "out"
+        extracted = extract_nested_archives(
+            linked_tar, out, flatten=False, should_extract=lambda p: p.name != "orig.txt"
+        )
+        
+        root = out / "linked.tar" / "a"
+        assert sorted(p.name for p in extracted) == ["link.txt", "run.sh"]
+        assert not (root / "orig.txt").exists()
+        assert (root / "link.txt").read_text() == "orig"
+        assert (root / "run.sh").stat().st_mode & 0o777 == 0o755
+        assert (root / "run.sh").stat().st_mtime == 1_000_000_000
+    
+    def test_zip_backend_keeps_metadata(self, tmp_path):
+        """Test that unfiltered nested extraction keeps ZIP permissions and mtimes."""
+        info = zipfile.ZipInfo("run.sh", date_time=(2001, 9, 9, 1, 46, 40))
+        info.create_system = 3
+        info.external_attr = 0o100755 << 16
+        archive = tmp_path / "script.zip"
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr(info, "#!/bin/sh\n")
+        
+        [script] = extract_nested_archives(archive, tmp_path / "out", flatten=False)
+        
+        assert script.stat().st_mode & 0o777 == 0o755
+        assert script.stat().st_mtime == time.mktime((2001, 9, 9, 1, 46, 40, 0, 0, -1))
+    
+    def test_tar_backend_skips_unsafe_members(self, tmp_path):
+        """Test that a member the data filter rejects is skipped, not the whole archive."""
+        archive = tmp_path / "pkg.tar"
+        with tarfile.open(archive, "w") as tf:
+            for name in ("pkg/a.txt", "pkg/b.txt"):
+                info = tarfile.TarInfo(name)
+                tf.addfile(info)
+            link = tarfile.TarInfo("pkg/hosts")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "/etc/hosts"
+            tf.addfile(link)
+            tf.addfile(tarfile.TarInfo("pkg/z.txt"))
+        out = tmp_path / "out"
+        
+        extracted = extract_nested_archives(archive, out, flatten=False)
+        
+        assert sorted(p.name for p in extracted) == ["a.txt", "b.txt", "z.txt"]
+        assert not (out / "pkg" / "pkg" / "hosts").is_symlink()
+    
+    def test_zip_backend_falls_back_for_unsupported_compression(self, tmp_path, monkeypatch):
+        """Test that ZIPs zipfile cannot decompress are handed to patool instead."""
+        archive = tmp_path / "deflated.zip"
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("docs/b.txt", "b")
+        monkeypatch.setattr(data_utils, "_ZIP_METHODS", frozenset({zipfile.ZIP_STORED}))
+        out = tmp_path / "out"
+        
+        extracted = extract_nested_archives(archive, out, flatten=False)
+        
+        assert extracted == [out / "deflated" / "docs" / "b.txt"]
+        assert extracted[0].read_text() == "b"
+    
+    def test_streamed_zip_falls_back_for_unsupported_compression(
+        self, built_archive, tmp_path, monkeypatch
+    ):
+        """Test that streamed ZIPs zipfile cannot decompress are still filtered and placed."""
+        monkeypatch.setattr(data_utils, "_ZIP_METHODS", frozenset())
+        extract_with_patool = data_utils._extract_with_patool
+        handed_over = []
+        
+        def spy(archive, outdir, *args):
+            handed_over.append(archive.name)
+            extract_with_patool(archive, outdir, *args)
+        
+        monkeypatch.setattr(data_utils, "_extract_with_patool", spy)
+        out = tmp_path / "out"
+        
+        extracted = extract_nested_archives(
+            built_archive, out, parallel=False, should_extract=lambda p: p.name != "a.txt"
+        )
+        
+        assert sorted(handed_over) == ["more.zip", "outer.zip"]
+        assert sorted(p.name for p in extracted) == ["b.txt", "c.txt", "readme.txt", "readme_1.txt"]
+        assert sorted(p.name for p in out.iterdir()) == sorted(p.name for p in extracted)
+    
+    def test_failing_predicate_propagates_in_flat_mode(self, built_archive, tmp_path):
+        """Test that a raising should_extract reaches the caller instead of failing the archive."""
+        def should_extract(path: Path) -> bool:
+            raise RuntimeError("boom")
+        
+        with pytest.raises(RuntimeError, match="boom"):
+            extract_nested_archives(built_archive, tmp_path / "out", should_extract=should_extract)
+    
+    def test_failing_predicate_keeps_earlier_members_in_nested_mode(self, built_archive, tmp_path):
+        """Test that a raising should_extract ends only that archive, as the walk does."""
+        def should_extract(path: Path) -> bool:
+            if path.name == "more.zip":
+                raise RuntimeError("boom")
+            return True
+        
+        out = tmp_path / "out"
+        extracted = extract_nested_archives(
+            built_archive, out, flatten=False, should_extract=should_extract
+        )
+        
+        assert sorted(p.relative_to(out).as_posix() for p in extracted) == [
+            "outer/docs/b.txt",
+            "outer/inner.tar.gz",
+            "outer/inner.tar/inner/a.txt",
+            "outer/inner.tar/inner/readme.txt",
+            "outer/readme.txt",
+        ]
+    
+    def test_failing_callback_does_not_stop_flat_extraction(self, built_archive, tmp_path):
+        """Test that a raising callback only drops that file from the results."""
+        def callback(path: Path) -> None:
+            if path.name == "b.txt":
+                raise RuntimeError("callback failed")
+        
+        out = tmp_path / "out"
+        extracted = extract_nested_archives(built_archive, out, extract_callback=callback)
+        
+        assert sorted(p.name for p in extracted) == [
+            "a.txt", "c.txt", "readme.txt", "readme_1.txt"
+        ]
+        assert sorted(p.name for p in out.iterdir()) == [
+            "a.txt", "b.txt", "c.txt", "readme.txt", "readme_1.txt"
+        ]
+    
+    def test_flat_retries_on_disk_when_tmpfs_fails(self, built_archive, tmp_path, monkeypatch):
+        """Test that archives failing in tmpfs scratch, e.g. when full, are retried on disk."""
+        fake_tmpfs = tmp_path / "shm"
+        fake_tmpfs.mkdir()
+        monkeypatch.setattr(data_utils, "_TMPFS", str(fake_tmpfs))
+        extract_archive = data_utils._extract_archive
+        
+        def tmpfs_is_full(archive, outdir, *args, **kwargs):
+            if outdir.is_relative_to(fake_tmpfs):
+                return False
+            return extract_archive(archive, outdir, *args, **kwargs)
+        
+        monkeypatch.setattr(data_utils, "_extract_archive", tmpfs_is_full)
+        extracted = extract_nested_archives(built_archive, tmp_path / "out", parallel=False)
+        
+        assert sorted(p.name for p in extracted) == [
+            "a.txt", "b.txt", "c.txt", "readme.txt", "readme_1.txt"
+        ]
+        assert list(fake_tmpfs.iterdir()) == []
+    
+    def test_flat_keeps_nested_archives_that_fail(self, tmp_path):
+        """Test that a plain file with an archive suffix is moved out like any other leaf."""
+        archive = tmp_path / "outer.zip"
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("fake.zip", "not a zip")
+            zf.writestr("fake2.zip", "not a zip either")
+            zf.writestr("b.txt", "b")
+        
+        for parallel in (False, True):
+            out = tmp_path / f"out_{parallel}"
+            extracted = extract_nested_archives(archive, out, parallel=parallel)
+            
+            assert sorted(p.name for p in extracted) == ["b.txt", "fake.zip", "fake2.zip"]
+            assert (out / "fake.zip").read_text() == "not a zip"
+    
+    def test_flat_collisions_on_case_insensitive_filesystem(self, tmp_path, monkeypatch):
+        """Test that names differing only in case are renamed where the filesystem ignores case."""
+        archive = tmp_path / "cases.zip"
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("README.txt", "upper")
+            zf.writestr("sub/readme.txt", "lower")
+            zf.writestr("notes.txt", "notes")
+        out = tmp_path / "out"
+        out.mkdir()
+        (out / "Notes.TXT").write_text("existing")
+        monkeypatch.setattr(data_utils, "_is_case_insensitive", lambda directory: True)
+        
+        extracted = extract_nested_archives(archive, out, parallel=False)
+        
+        assert sorted(p.name for p in extracted) == ["README.txt", "notes_1.txt", "readme_1.txt"]
+        assert (out / "readme_1.txt").read_text() == "lower"